@@ -1,20 +1,52 @@
 # app.py
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
-from fastapi import Request
+from fastapi.responses import FileResponse, ORJSONResponse, Response
+from fastapi.concurrency import run_in_threadpool
 import socketio
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Text
+from sqlalchemy import create_engine, event, inspect, text, Column, Index, Integer, String, DateTime, ForeignKey, Text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.sql import func
+from sqlalchemy.orm import sessionmaker, Session, relationship, joinedload, aliased
 from datetime import datetime
+import asyncio
 import uvicorn
 import json
+import os
+import zlib
+import orjson
 
 # Database setup
 SQLALCHEMY_DATABASE_URL = "sqlite:///./chat_app.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=20,
+    max_overflow=10,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+)
+
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=10737418240",
+    "PRAGMA busy_timeout=3000",
+)
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragma(dbapi_conn, _):
+    cursor = dbapi_conn.cursor()
+    # WAL needs a file on disk, so leave in-memory databases alone
+    if ":memory:" not in SQLALCHEMY_DATABASE_URL:
+        cursor.execute("PRAGMA journal_mode=WAL")
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -46,14 +78,60 @@ class Message(Base):
     content = Column(Text)
     user_id = Column(Integer, ForeignKey("users.id"))
     channel_id = Column(Integer, ForeignKey("channels.id"))
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    # send_message stamps rows itself so the ISO string is ready for the broadcast;
+    # SQLite fills it in for any other insert
+    timestamp = Column(DateTime, server_default=func.now(), nullable=False)
+    # Serialized once at insert time so reads don't call isoformat() per message
+    timestamp_iso = Column(String, nullable=True,
+                           server_default=text("(strftime('%Y-%m-%dT%H:%M:%S', 'now'))"))
     
     user = relationship("User", back_populates="messages")
     channel = relationship("Channel", back_populates="messages")
 
+    # ix_messages_channel_ts backs the per-channel "latest N messages" query (SQLite
+    # walks it backwards for DESC); ix_messages_channel_id_id makes the max(id)
+    # behind the history ETag a seek instead of a scan of the channel
+    __table_args__ = (
+        Index("ix_messages_channel_ts", "channel_id", "timestamp"),
+        Index("ix_messages_channel_id_id", "channel_id", "id"),
+    )
+
 # Create tables
 Base.metadata.create_all(bind=engine)
 
+# create_all skips existing tables, so upgrade databases created before these existed
+for index in Message.__table__.indexes:
+    index.create(bind=engine, checkfirst=True)
+
+if "timestamp_iso" not in {column["name"] for column in inspect(engine).get_columns("messages")}:
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE messages ADD COLUMN timestamp_iso VARCHAR"))
+        conn.execute(text("UPDATE messages SET timestamp_iso = replace(timestamp, ' ', 'T')"))
+
+# In development, log every lazy relationship load so n+1 query patterns show up
+# with the line that triggered them
+if os.environ.get("APP_ENV") == "dev":
+    import logging
+    import traceback
+
+    logging.basicConfig()
+    nplusone_logger = logging.getLogger("nplusone")
+    nplusone_logger.setLevel(logging.WARNING)
+
+    @event.listens_for(SessionLocal, "do_orm_execute")
+    def _warn_on_lazy_load(orm_execute_state):
+        if not orm_execute_state.is_select:
+            return
+        state = orm_execute_state.lazy_loaded_from
+        if state is None:
+            return
+        source = next((frame for frame in reversed(traceback.extract_stack())
+                       if frame.filename == __file__ and frame.name != "_warn_on_lazy_load"), None)
+        location = f" at line {source.lineno}: {source.line}" if source else ""
+        nplusone_logger.warning(
+            f"Potential n+1 query: lazy load on {state.class_.__name__}{location}"
+        )
+
 # Dependency to get database session
 def get_db():
     db = SessionLocal()
@@ -63,279 +141,613 @@ def get_db():
         db.close()
 
 # Initialize FastAPI app
-app = FastAPI(title="Discord-like Chat App")
+app = FastAPI(title="Discord-like Chat App", default_response_class=ORJSONResponse)
+
+class ORJSONWrapper:
+    """json-module stand-in so Socket.IO packets are encoded with orjson."""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        # orjson output is already compact, so the separators socketio passes are moot
+        return orjson.dumps(obj).decode()
+
+    loads = staticmethod(orjson.loads)
+
+# Set REDIS_URL to share rooms and presence between several workers
+REDIS_URL = os.environ.get("REDIS_URL")
 
 # Socket.IO setup
-sio = socketio.AsyncServer(cors_allowed_origins="*", async_mode='asgi')
+client_manager = socketio.AsyncRedisManager(REDIS_URL) if REDIS_URL else None
+sio = socketio.AsyncServer(cors_allowed_origins="*", async_mode='asgi', json=ORJSONWrapper,
+                           client_manager=client_manager)
 socket_app = socketio.ASGIApp(sio, app)
 
-# Templates setup
-templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # Store active users and their channels
-active_users = {}
-user_channels = {}
+class LocalPresence:
+    """Active users and their channels, kept in this process. Each user's
+    channels are an int bitmap with bit N set for channel id N."""
+
+    def __init__(self):
+        self.active_users = {}
+        self.user_channels = {}
+
+    @staticmethod
+    def _channel_ids(mask: int):
+        channel_ids = []
+        while mask:
+            lowest = mask & -mask
+            channel_ids.append(lowest.bit_length() - 1)
+            mask ^= lowest
+        return channel_ids
+
+    async def add_user(self, sid: str, user_id: int, username: str):
+        self.active_users[sid] = (user_id, username)
+        self.user_channels[sid] = 0
+
+    async def remove_user(self, sid: str):
+        """Returns the (user_id, username) that was removed, or None, and their channels."""
+        return (self.active_users.pop(sid, None),
+                self._channel_ids(self.user_channels.pop(sid, 0)))
+
+    async def get_member(self, sid: str, channel_id: int):
+        """Returns (user_id, username) if the user has joined the channel."""
+        if self.user_channels.get(sid, 0) >> channel_id & 1:
+            return self.active_users.get(sid)
+        return None
+
+    async def join_channel(self, sid: str, channel_id: int):
+        if sid in self.user_channels:
+            self.user_channels[sid] |= 1 << channel_id
+
+    async def leave_channel(self, sid: str, channel_id: int):
+        if sid in self.user_channels:
+            self.user_channels[sid] &= ~(1 << channel_id)
+
+class RedisPresence:
+    """Same interface as LocalPresence, stored in Redis so every worker sees it.
+    Keys expire after PRESENCE_TTL without activity, so sids left behind by a
+    worker that died without handling their disconnect are cleaned up."""
+
+    PRESENCE_TTL = 24 * 60 * 60  # seconds
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    @staticmethod
+    def _user_key(sid: str):
+        return f"active_user:{sid}"
+
+    @staticmethod
+    def _channels_key(sid: str):
+        return f"user_channels:{sid}"
+
+    def _touch(self, pipe, sid: str):
+        pipe.expire(self._user_key(sid), self.PRESENCE_TTL)
+        pipe.expire(self._channels_key(sid), self.PRESENCE_TTL)
+
+    async def add_user(self, sid: str, user_id: int, username: str):
+        async with self.redis.pipeline() as pipe:
+            pipe.set(self._user_key(sid), orjson.dumps([user_id, username]), ex=self.PRESENCE_TTL)
+            pipe.delete(self._channels_key(sid))
+            await pipe.execute()
+
+    async def remove_user(self, sid: str):
+        async with self.redis.pipeline() as pipe:
+            pipe.get(self._user_key(sid))
+            pipe.smembers(self._channels_key(sid))
+            pipe.delete(self._user_key(sid), self._channels_key(sid))
+            user, channel_ids, _ = await pipe.execute()
+        if user is None:
+            return None, set()
+        return tuple(orjson.loads(user)), {int(channel_id) for channel_id in channel_ids}
+
+    async def get_member(self, sid: str, channel_id: int):
+        async with self.redis.pipeline() as pipe:
+            pipe.get(self._user_key(sid))
+            pipe.sismember(self._channels_key(sid), channel_id)
+            self._touch(pipe, sid)
+            user, is_member, _, _ = await pipe.execute()
+        if user is None or not is_member:
+            return None
+        return tuple(orjson.loads(user))
+
+    async def join_channel(self, sid: str, channel_id: int):
+        async with self.redis.pipeline() as pipe:
+            pipe.sadd(self._channels_key(sid), channel_id)
+            self._touch(pipe, sid)
+            await pipe.execute()
+
+    async def leave_channel(self, sid: str, channel_id: int):
+        await self.redis.srem(self._channels_key(sid), channel_id)
+
+if REDIS_URL:
+    import redis.asyncio as redis
+    redis_client = redis.from_url(REDIS_URL)
+    presence = RedisPresence(redis_client)
+else:
+    redis_client = None
+    presence = LocalPresence()
+
+# Incoming messages are queued and written in batches, one commit per batch
+MESSAGE_BATCH_SIZE = 32
+MESSAGE_BATCH_WINDOW = 0.02  # seconds
+MESSAGE_SAVE_ATTEMPTS = 3
+message_queue = asyncio.Queue()
+# Cleared on shutdown so nothing is queued while the writer drains
+accepting_messages = True
+
+# Channels only change through create_channel, so keep them in memory. With
+# several workers, create_channel bumps a generation counter in Redis and the
+# other workers reload from the database when they see it change;
+# join_channel also falls back to the database on a cache miss.
+channels_cache = []
+channels_by_id = {}
+CHANNELS_GENERATION_KEY = "channels_generation"
+channels_generation = None
+# Derived from the cached ids rather than a counter so workers holding the
+# same channels agree on it; used as the /api/channels ETag
+channels_version = 0
 
 # Helper functions
 def create_default_channels():
     db = SessionLocal()
     try:
-        # Check if channels exist
-        if db.query(Channel).count() == 0:
-            default_channels = [
-                Channel(name="general", description="General discussion"),
-                Channel(name="random", description="Random conversations"),
-                Channel(name="tech", description="Technology discussions"),
-            ]
-            for channel in default_channels:
-                db.add(channel)
-            db.commit()
+        # Insert any missing defaults in one idempotent statement
+        db.execute(sqlite_insert(Channel).values([
+            {"name": "general", "description": "General discussion"},
+            {"name": "random", "description": "Random conversations"},
+            {"name": "tech", "description": "Technology discussions"},
+        ]).on_conflict_do_nothing(index_elements=["name"]))
+        db.commit()
     finally:
         db.close()
 
-def get_user_by_socket_id(socket_id: str, db: Session):
-    return db.query(User).filter(User.socket_id == socket_id).first()
+def serialize_channel(channel: Channel):
+    return {"id": channel.id, "name": channel.name, "description": channel.description}
 
-def get_channel_messages(channel_id: int, db: Session, limit: int = 50):
-    return db.query(Message).filter(Message.channel_id == channel_id)\
-             .order_by(Message.timestamp.desc()).limit(limit).all()[::-1]
+def cache_channel(channel_data: dict):
+    global channels_version
+    if channel_data["id"] in channels_by_id:
+        return
+    channels_cache.append(channel_data)
+    channels_by_id[channel_data["id"]] = channel_data
+    channels_version = zlib.crc32(orjson.dumps(sorted(channels_by_id)))
 
-# FastAPI Routes
-@app.get("/", response_class=HTMLResponse)
-async def home(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+def is_known_channel(channel_id):
+    # Presence bitmaps shift by the id, so only accept ids of existing channels
+    return type(channel_id) is int and channel_id in channels_by_id
 
-@app.get("/chat", response_class=HTMLResponse)
-async def chat_page(request: Request, username: str):
+def _fetch_channels():
     db = SessionLocal()
     try:
-        channels = db.query(Channel).all()
-        return templates.TemplateResponse("chat.html", {
-            "request": request,
-            "username": username,
-            "channels": channels
-        })
+        return [serialize_channel(channel)
+                for channel in db.query(Channel).order_by(Channel.id).all()]
     finally:
         db.close()
 
-@app.get("/api/channels")
-async def get_channels(db: Session = Depends(get_db)):
-    channels = db.query(Channel).all()
-    return [{"id": channel.id, "name": channel.name, "description": channel.description} 
-            for channel in channels]
+def load_channels():
+    for channel_data in _fetch_channels():
+        cache_channel(channel_data)
 
-@app.get("/api/channels/{channel_id}/messages")
-async def get_channel_messages_api(channel_id: int, db: Session = Depends(get_db)):
-    messages = get_channel_messages(channel_id, db)
-    return [{
+async def sync_channels():
+    """Pick up channels created by other workers."""
+    global channels_generation
+    if redis_client is None:
+        return
+    generation = await redis_client.get(CHANNELS_GENERATION_KEY)
+    if generation != channels_generation:
+        for channel_data in await run_in_threadpool(_fetch_channels):
+            cache_channel(channel_data)
+        channels_generation = generation
+
+def get_user_by_socket_id(socket_id: str, db: Session):
+    return db.query(User).filter(User.socket_id == socket_id).first()
+
+def get_channel_messages(channel_id: int, db: Session, limit: int = 50):
+    # Take the latest `limit` rows, then re-sort them oldest-first in SQL
+    latest = db.query(Message).filter(Message.channel_id == channel_id)\
+               .order_by(Message.timestamp.desc()).limit(limit).subquery()
+    recent = aliased(Message, latest)
+    return db.query(recent).options(joinedload(recent.user))\
+             .order_by(latest.c.timestamp.asc()).all()
+
+def get_latest_message_id(channel_id: int, db: Session):
+    # Messages are append-only and ids follow commit order, so the highest id
+    # changes whenever the history does
+    return db.query(func.max(Message.id)).filter(Message.channel_id == channel_id).scalar()
+
+def serialize_message(msg: Message):
+    return {
         "id": msg.id,
         "content": msg.content,
         "username": msg.user.username,
-        "timestamp": msg.timestamp.isoformat(),
+        # Upgraded databases have no server default for timestamp_iso
+        "timestamp": msg.timestamp_iso or msg.timestamp.isoformat(),
         "channel_id": msg.channel_id
-    } for msg in messages]
+    }
 
-# Socket.IO Events
-@sio.event
-async def connect(sid, environ):
-    print(f"Client {sid} connected")
+# FastAPI Routes
+# The pages are static; chat.html reads the username from the query string
+# and loads its channel list from /api/channels
+@app.get("/")
+async def home():
+    return FileResponse("templates/index.html")
 
-@sio.event
-async def disconnect(sid):
-    print(f"Client {sid} disconnected")
+@app.get("/chat")
+async def chat_page(username: str):
+    return FileResponse("templates/chat.html")
+
+def is_not_modified(request: Request, etag: str):
+    if_none_match = request.headers.get("if-none-match", "")
+    return etag in (tag.strip() for tag in if_none_match.split(","))
+
+# Clients revalidate with If-None-Match and get a 304 while nothing has changed
+REVALIDATE_HEADERS = {"Cache-Control": "no-cache"}
+
+@app.get("/api/channels")
+async def get_channels(request: Request, response: Response):
+    await sync_channels()
+    etag = f'W/"chan-{channels_version}"'
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, **REVALIDATE_HEADERS})
+    response.headers.update({"ETag": etag, **REVALIDATE_HEADERS})
+    return channels_cache
+
+# Plain `def` so FastAPI runs the database work in its threadpool
+@app.get("/api/channels/{channel_id}/messages")
+def get_channel_messages_api(channel_id: int, request: Request, response: Response,
+                             db: Session = Depends(get_db)):
+    etag = f'W/"ch{channel_id}-max{get_latest_message_id(channel_id, db) or 0}"'
+    if is_not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, **REVALIDATE_HEADERS})
+    response.headers.update({"ETag": etag, **REVALIDATE_HEADERS})
+    messages = get_channel_messages(channel_id, db)
+    return [serialize_message(msg) for msg in messages]
+
+# Blocking database work for the Socket.IO events. These run via run_in_threadpool
+# so commits and queries never stall the event loop, and only return plain data.
+def _disconnect_user(socket_id: str):
     db = SessionLocal()
     try:
-        user = get_user_by_socket_id(sid, db)
+        user = get_user_by_socket_id(socket_id, db)
         if user:
             # Update user status
             user.socket_id = None
             db.commit()
-            
-            # Remove from active users
-            if sid in active_users:
-                username = active_users[sid]
-                del active_users[sid]
-                
-                # Notify all channels the user left
-                if sid in user_channels:
-                    for channel_id in user_channels[sid]:
-                        await sio.emit('user_left', {
-                            'username': username,
-                            'channel_id': channel_id
-                        }, room=f"channel_{channel_id}")
-                    del user_channels[sid]
     finally:
         db.close()
 
-@sio.event
-async def join_app(sid, data):
-    username = data['username']
+def _join_app(socket_id: str, username: str):
     db = SessionLocal()
     try:
         # Check if user exists, create if not
         user = db.query(User).filter(User.username == username).first()
         if not user:
-            user = User(username=username, socket_id=sid)
+            user = User(username=username, socket_id=socket_id)
             db.add(user)
             db.commit()
             db.refresh(user)
         else:
-            user.socket_id = sid
+            user.socket_id = socket_id
             db.commit()
-        
-        active_users[sid] = username
-        user_channels[sid] = set()
-        
-        await sio.emit('joined_app', {
-            'username': username,
-            'user_id': user.id
-        }, room=sid)
-        
+        return user.id
     finally:
         db.close()
 
-@sio.event
-async def join_channel(sid, data):
-    channel_id = data['channel_id']
+def _get_channel(channel_id: int):
     db = SessionLocal()
     try:
-        user = get_user_by_socket_id(sid, db)
         channel = db.query(Channel).filter(Channel.id == channel_id).first()
-        
-        if user and channel:
-            # Join the socket.io room for this channel
-            await sio.enter_room(sid, f"channel_{channel_id}")
-            
-            # Track user's channels
-            if sid in user_channels:
-                user_channels[sid].add(channel_id)
-            
-            # Get recent messages for this channel
-            messages = get_channel_messages(channel_id, db)
-            message_data = [{
-                "id": msg.id,
-                "content": msg.content,
-                "username": msg.user.username,
-                "timestamp": msg.timestamp.isoformat(),
-                "channel_id": msg.channel_id
-            } for msg in messages]
-            
-            await sio.emit('channel_joined', {
-                'channel_id': channel_id,
-                'channel_name': channel.name,
-                'messages': message_data
-            }, room=sid)
-            
-            # Notify others in the channel
-            await sio.emit('user_joined', {
-                'username': user.username,
-                'channel_id': channel_id
-            }, room=f"channel_{channel_id}", skip_sid=sid)
-            
+        return serialize_channel(channel) if channel else None
     finally:
         db.close()
 
-@sio.event
-async def leave_channel(sid, data):
-    channel_id = data['channel_id']
+def _join_channel(socket_id: str, channel_id: int):
     db = SessionLocal()
     try:
-        user = get_user_by_socket_id(sid, db)
-        
-        if user:
-            # Leave the socket.io room
-            await sio.leave_room(sid, f"channel_{channel_id}")
-            
-            # Remove from user's channels
-            if sid in user_channels:
-                user_channels[sid].discard(channel_id)
-            
-            # Notify others in the channel
-            await sio.emit('user_left', {
-                'username': user.username,
-                'channel_id': channel_id
-            }, room=f"channel_{channel_id}")
-            
+        user = get_user_by_socket_id(socket_id, db)
+        if not user:
+            return None
+
+        # Get recent messages for this channel
+        messages = get_channel_messages(channel_id, db)
+        return {
+            'username': user.username,
+            'messages': [serialize_message(msg) for msg in messages]
+        }
     finally:
         db.close()
 
-@sio.event
-async def send_message(sid, data):
-    channel_id = data['channel_id']
-    content = data['content']
-    
+def _leave_channel(socket_id: str):
     db = SessionLocal()
     try:
-        user = get_user_by_socket_id(sid, db)
-        channel = db.query(Channel).filter(Channel.id == channel_id).first()
-        
-        if user and channel and content.strip():
-            # Save message to database
-            message = Message(
+        user = get_user_by_socket_id(socket_id, db)
+        return user.username if user else None
+    finally:
+        db.close()
+
+def _insert_messages(batch: list):
+    """Insert a batch of (user_id, username, channel_id, content, timestamp)
+    tuples without committing. Returns the open session, which the caller must
+    pass to _commit_messages, and the broadcast payloads."""
+    db = SessionLocal()
+    try:
+        messages = []
+        message_data = []
+        for user_id, username, channel_id, content, timestamp in batch:
+            timestamp_iso = timestamp.isoformat()
+            messages.append(Message(
                 content=content,
-                user_id=user.id,
-                channel_id=channel_id
-            )
-            db.add(message)
-            db.commit()
-            db.refresh(message)
-            
-            # Broadcast message to all users in the channel
-            message_data = {
-                'id': message.id,
-                'content': message.content,
-                'username': user.username,
-                'timestamp': message.timestamp.isoformat(),
+                user_id=user_id,
+                channel_id=channel_id,
+                timestamp=timestamp,
+                timestamp_iso=timestamp_iso
+            ))
+            message_data.append({
+                'content': content,
+                'username': username,
+                'timestamp': timestamp_iso,
                 'channel_id': channel_id
-            }
-            
-            await sio.emit('new_message', message_data, room=f"channel_{channel_id}")
-            
+            })
+
+        # A single flush issues one batched INSERT and fills in the ids
+        db.add_all(messages)
+        db.flush()
+        for message, data in zip(messages, message_data):
+            data['id'] = message.id
+        return db, message_data
+    except Exception:
+        db.close()
+        raise
+
+def _commit_messages(db: Session):
+    try:
+        db.commit()
     finally:
         db.close()
 
+def _create_channel(socket_id: str, channel_name: str, channel_description: str):
+    """Returns (channel_data, error_message); both are None for unknown sockets."""
+    db = SessionLocal()
+    try:
+        user = get_user_by_socket_id(socket_id, db)
+        if not user:
+            return None, None
+
+        # Check if channel already exists
+        existing_channel = db.query(Channel).filter(Channel.name == channel_name).first()
+        if existing_channel:
+            return None, f'Channel "{channel_name}" already exists'
+
+        # Create new channel
+        new_channel = Channel(
+            name=channel_name,
+            description=channel_description
+        )
+        db.add(new_channel)
+        db.commit()
+        db.refresh(new_channel)
+
+        return serialize_channel(new_channel), None
+    finally:
+        db.close()
+
+async def save_messages(batch: list):
+    """Insert, broadcast and commit a batch. Returns False if it was not saved."""
+    try:
+        db, saved = await run_in_threadpool(_insert_messages, batch)
+    except Exception as exc:
+        print(f"Failed to insert messages: {exc}")
+        return False
+
+    # The ids are known after the flush, so broadcast while the commit runs
+    commit = asyncio.create_task(run_in_threadpool(_commit_messages, db))
+
+    # Broadcast messages to all users in their channels
+    try:
+        for message_data in saved:
+            await sio.emit('new_message', message_data,
+                           room=f"channel_{message_data['channel_id']}")
+    except Exception as exc:
+        # Still wait for the commit below; the messages are saved either way
+        print(f"Failed to broadcast messages: {exc}")
+
+    try:
+        await commit
+    except Exception as exc:
+        print(f"Failed to commit messages: {exc}")
+        # The rows were rolled back and their ids will be reused, so take the
+        # broadcast messages back before the batch is retried
+        retracted = {}
+        for message_data in saved:
+            retracted.setdefault(message_data['channel_id'], []).append(message_data['id'])
+        for channel_id, ids in retracted.items():
+            await sio.emit('messages_retracted', {
+                'channel_id': channel_id,
+                'ids': ids
+            }, room=f"channel_{channel_id}")
+        return False
+    return True
+
+async def message_writer():
+    loop = asyncio.get_running_loop()
+    while True:
+        # Wait for one message, then collect more until the batch window closes
+        batch = [await message_queue.get()]
+        deadline = loop.time() + MESSAGE_BATCH_WINDOW
+        while len(batch) < MESSAGE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(message_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            for attempt in range(1, MESSAGE_SAVE_ATTEMPTS + 1):
+                if await save_messages(batch):
+                    break
+                print(f"Failed to save {len(batch)} messages (attempt {attempt} of {MESSAGE_SAVE_ATTEMPTS})")
+        except Exception as exc:
+            # Keep the writer alive; a dead writer would silently drop every later message
+            print(f"Message writer error: {exc}")
+        finally:
+            for _ in batch:
+                message_queue.task_done()
+
+@app.on_event("startup")
+async def start_message_writer():
+    app.state.message_writer = asyncio.create_task(message_writer())
+
+@app.on_event("shutdown")
+async def stop_message_writer():
+    global accepting_messages
+    # Stop intake, let the writer save what is already queued, then stop it
+    accepting_messages = False
+    await message_queue.join()
+    app.state.message_writer.cancel()
+
+# Socket.IO Events
+@sio.event
+async def connect(sid, environ):
+    print(f"Client {sid} connected")
+
+@sio.event
+async def disconnect(sid):
+    print(f"Client {sid} disconnected")
+    await run_in_threadpool(_disconnect_user, sid)
+    
+    # Remove from active users even if the username has since reconnected
+    # under another socket and the database row no longer points at this sid
+    user, channel_ids = await presence.remove_user(sid)
+    if user:
+        _, username = user
+        
+        # Notify all channels the user left; each payload names its own
+        # channel, so send them concurrently rather than as one emit
+        await asyncio.gather(*[sio.emit('user_left', {
+            'username': username,
+            'channel_id': channel_id
+        }, room=f"channel_{channel_id}") for channel_id in channel_ids])
+
+@sio.event
+async def join_app(sid, data):
+    username = data['username']
+    user_id = await run_in_threadpool(_join_app, sid, username)
+    
+    await presence.add_user(sid, user_id, username)
+    
+    await sio.emit('joined_app', {
+        'username': username,
+        'user_id': user_id
+    }, room=sid)
+
+@sio.event
+async def join_channel(sid, data):
+    channel_id = data['channel_id']
+    if type(channel_id) is not int:
+        return
+    channel = channels_by_id.get(channel_id)
+    if not channel:
+        # It may have been created by another worker
+        channel = await run_in_threadpool(_get_channel, channel_id)
+        if not channel:
+            return
+        cache_channel(channel)
+    
+    # Join the socket.io room for this channel before reading its history, so a
+    # message saved in between is broadcast to this client rather than lost
+    await sio.enter_room(sid, f"channel_{channel_id}")
+    joined = await run_in_threadpool(_join_channel, sid, channel_id)
+    
+    if not joined:
+        await sio.leave_room(sid, f"channel_{channel_id}")
+    else:
+        # Track user's channels
+        await presence.join_channel(sid, channel_id)
+        
+        await sio.emit('channel_joined', {
+            'channel_id': channel_id,
+            'channel_name': channel['name'],
+            'messages': joined['messages']
+        }, room=sid)
+        
+        # Notify others in the channel
+        await sio.emit('user_joined', {
+            'username': joined['username'],
+            'channel_id': channel_id
+        }, room=f"channel_{channel_id}", skip_sid=sid)
+
+@sio.event
+async def leave_channel(sid, data):
+    channel_id = data['channel_id']
+    if not is_known_channel(channel_id):
+        return
+    username = await run_in_threadpool(_leave_channel, sid)
+    
+    if username:
+        # Leave the socket.io room
+        await sio.leave_room(sid, f"channel_{channel_id}")
+        
+        # Remove from user's channels
+        await presence.leave_channel(sid, channel_id)
+        
+        # Notify others in the channel
+        await sio.emit('user_left', {
+            'username': username,
+            'channel_id': channel_id
+        }, room=f"channel_{channel_id}")
+
+@sio.event
+async def send_message(sid, data):
+    channel_id = data['channel_id']
+    content = data['content']
+    
+    if not is_known_channel(channel_id) or not content.strip():
+        return
+    
+    # Only users who joined the app and this channel may post to it
+    if not accepting_messages:
+        await sio.emit('error', {
+            'message': 'The server is restarting, please send your message again shortly'
+        }, room=sid)
+        return
+    
+    user = await presence.get_member(sid, channel_id)
+    if not user:
+        await sio.emit('error', {
+            'message': 'Join the channel before sending messages to it'
+        }, room=sid)
+        return
+    
+    user_id, username = user
+    # Saved and broadcast by message_writer
+    message_queue.put_nowait((user_id, username, channel_id, content, datetime.utcnow()))
+
 @sio.event
 async def create_channel(sid, data):
     channel_name = data['name']
     channel_description = data.get('description', '')
+    channel_data, error = await run_in_threadpool(
+        _create_channel, sid, channel_name, channel_description
+    )
     
-    db = SessionLocal()
-    try:
-        user = get_user_by_socket_id(sid, db)
+    if error:
+        await sio.emit('error', {'message': error}, room=sid)
+    elif channel_data:
+        cache_channel(channel_data)
+        if redis_client is not None:
+            await redis_client.incr(CHANNELS_GENERATION_KEY)
         
-        if user:
-            # Check if channel already exists
-            existing_channel = db.query(Channel).filter(Channel.name == channel_name).first()
-            if existing_channel:
-                await sio.emit('error', {
-                    'message': f'Channel "{channel_name}" already exists'
-                }, room=sid)
-                return
-            
-            # Create new channel
-            new_channel = Channel(
-                name=channel_name,
-                description=channel_description
-            )
-            db.add(new_channel)
-            db.commit()
-            db.refresh(new_channel)
-            
-            # Broadcast new channel to all connected users
-            channel_data = {
-                'id': new_channel.id,
-                'name': new_channel.name,
-                'description': new_channel.description
-            }
-            
-            await sio.emit('channel_created', channel_data)
-            
-    finally:
-        db.close()
+        # Broadcast new channel to all connected users
+        await sio.emit('channel_created', channel_data)
 
 # Initialize default channels
 create_default_channels()
+load_channels()
 
 if __name__ == "__main__":
-    uvicorn.run("app:socket_app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    uvicorn.run("app:socket_app", host="0.0.0.0", port=8000, reload=True)